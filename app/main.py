@@ -1,31 +1,54 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select, insert, and_, or_, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import SessionLocal, engine
 import models
-import requests
+import schemas
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 import os
-from datetime import datetime
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from prometheus_client import start_http_server
+import sys
+import asyncio
+import logging
+import unicodedata
+from datetime import datetime, timezone
+from prometheus_client import make_asgi_app
+from metrics import REQUEST_OK, REQUEST_ERR, REQUEST_LATENCY, CACHE_HITS, CACHE_MISSES, WRITES_DROPPED
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 
-REQUEST_COUNT = Counter('weather_requests_total', 'Total weather requests', ['status'])
-REQUEST_LATENCY = Histogram('weather_request_latency_seconds', 'Request latency in seconds')
+logger = logging.getLogger(__name__)
 
 
-models.Base.metadata.create_all(bind=engine)
-
 app = FastAPI(
     title="Weather API",
     description="API для получения погоды с сохранением в базу данных и мониторингом",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# метрики Prometheus отдаем из основного приложения
+app.mount("/metrics", make_asgi_app())
+
 # конфиг
 WEATHER_API_PROVIDER = os.getenv("WEATHER_API_PROVIDER", "openmeteo")
 OPENMETEO_URL = "https://api.open-meteo.com/v1/forecast"
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "300"))
+# сколько храним последний ответ на случай недоступности API
+STALE_TTL = int(os.getenv("WEATHER_STALE_TTL", "86400"))
+# максимальный размер пачки при записи в бд
+WRITE_BATCH_SIZE = 100
+# сколько записей может ждать в очереди, пока бд не успевает
+WRITE_QUEUE_SIZE = 10000
+# сколько ждем дозаписи очереди при остановке, секунд
+WRITE_DRAIN_TIMEOUT = 10
+# как долго считаем результат проверки API актуальным, секунд
+HEALTH_CACHE_TTL = 5
 
 # координаты городов
 CITY_COORDINATES = {
@@ -41,6 +64,21 @@ CITY_COORDINATES = {
     "казань": {"lat": 55.7961, "lon": 49.1064},
 }
 
+# таблица поиска с нормализованными названиями (NFKC + casefold)
+_CITY_LUT: Dict[str, Tuple[float, float]] = {
+    sys.intern(unicodedata.normalize("NFKC", k).casefold()): (v["lat"], v["lon"])
+    for k, v in CITY_COORDINATES.items()
+}
+
+# готовые URL запроса к API для каждого города - строка запроса не собирается на каждый запрос
+OPENMETEO_CURRENT = "temperature_2m,relative_humidity_2m,wind_speed_10m,wind_direction_10m,weather_code"
+_CITY_URLS: Dict[Tuple[float, float], httpx.URL] = {
+    (lat, lon): httpx.URL(
+        f"{OPENMETEO_URL}?latitude={lat}&longitude={lon}&current={OPENMETEO_CURRENT}&timezone=auto"
+    )
+    for lat, lon in _CITY_LUT.values()
+}
+
 # коды погоды 
 WEATHER_CODES = {
     0: "Ясно",
@@ -73,215 +111,333 @@ WEATHER_CODES = {
     99: "Гроза с сильным градом"
 }
 
+# статические ответы сериализуем один раз при импорте
+WEATHER_CODES_BYTES = orjson.dumps(WEATHER_CODES, option=orjson.OPT_NON_STR_KEYS)
+AVAILABLE_CITIES_BYTES = orjson.dumps({
+    "available_cities": list(CITY_COORDINATES),
+    "count": len(CITY_COORDINATES)
+})
+ROOT_BYTES = orjson.dumps({
+    "message": "Weather API с Open-Meteo",
+    "description": "Бесплатный API погоды без регистрации и ключей",
+    "version": "1.0.0",
+    "endpoints": {
+        "get_weather": "GET /weather/{city}",
+        "history": "GET /history/?limit=10&before_ts=...&before_id=...",
+        "health": "GET /health",
+        "metrics": "GET /metrics/",
+        "weather_codes": "GET /weather-codes",
+        "available_cities": "GET /available-cities",
+        "docs": "GET /docs"
+    },
+    "provider": WEATHER_API_PROVIDER
+})
+
+# текущее время в ISO формате с точностью до секунды: [секунда, строка]
+_ts_cache = [0, ""]
+
+def iso_now() -> str:
+    """текущее время UTC в ISO формате, форматируем не чаще раза в секунду"""
+    t = int(time.time())
+    if t != _ts_cache[0]:
+        _ts_cache[:] = [t, datetime.utcfromtimestamp(t).isoformat()]
+    return _ts_cache[1]
+
+# последний результат проверки API для /health
+_health_cache = {"ts": float("-inf"), "api_status": "unknown"}
+_health_lock = asyncio.Lock()
+
+# запросы к API, выполняющиеся прямо сейчас, по ключу кэша
+_inflight: Dict[str, asyncio.Task] = {}
+
 @app.on_event("startup")
 async def startup_event():
-    """Запускаем HTTP сервер для метрик Prometheus при старте приложения"""
-    start_http_server(8001)
+    """Создаем таблицы и общие клиенты при старте приложения"""
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        # create_all не добавляет индексы в уже существующую таблицу
+        await conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_weather_timestamp_desc "
+            "ON weather_requests (timestamp DESC, id DESC)"
+        ))
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+        http2=True,
+        headers={"Accept-Encoding": "br, gzip"}
+    )
+    app.state.redis = aioredis.from_url(REDIS_URL)
+    app.state.write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    app.state.writer = asyncio.create_task(persist_weather_batches(app.state.write_queue))
 
-def get_db():
-    db = SessionLocal()
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Дописываем очередь в бд и закрываем соединения при остановке приложения"""
     try:
+        await asyncio.wait_for(app.state.write_queue.join(), timeout=WRITE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Не удалось дописать %d запросов погоды в бд при остановке", app.state.write_queue.qsize())
+    app.state.writer.cancel()
+    await app.state.http.aclose()
+    await app.state.redis.aclose()
+    await engine.dispose()
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def get_city_coordinates(city: str) -> Dict[str, float]:
-    """получаем координаты города по его названию"""
-    city_lower = city.lower().strip()
-    
-    # Проверяем в нашем словаре
-    if city_lower in CITY_COORDINATES:
-        return CITY_COORDINATES[city_lower]
-    
-    # Если город не найден, используем Москву по умолчанию
-    return {"lat": 55.7558, "lon": 37.6173}
+async def persist_weather_batches(queue: asyncio.Queue):
+    """фоновая запись запросов погоды в бд пачками - один запрос к бд на пачку"""
+    while True:
+        items = [await queue.get()]
+        while not queue.empty() and len(items) < WRITE_BATCH_SIZE:
+            items.append(queue.get_nowait())
+
+        try:
+            async with SessionLocal() as db:
+                async with db.begin():
+                    await db.execute(insert(models.WeatherRequest), items)
+        except Exception:
+            logger.exception("Не удалось сохранить %d запросов погоды в бд", len(items))
+        finally:
+            for _ in items:
+                queue.task_done()
+
+def get_city_coordinates(city: str) -> Optional[Tuple[float, float]]:
+    """получаем координаты города по его названию, None если город не поддерживается"""
+    key = unicodedata.normalize("NFKC", city).strip().casefold()
+    return _CITY_LUT.get(key)
 
-def get_weather_from_openmeteo(city: str) -> Dict[str, Any]:
-    """получаем погоду из API"""
+async def get_weather_from_openmeteo(coords: Tuple[float, float], client: httpx.AsyncClient) -> Dict[str, Any]:
+    """получаем погоду из API по координатам города"""
+    lat, lon = coords
+    
     try:
-        # Получаем координаты города
-        coords = get_city_coordinates(city)
-        
-        # параметры
-        params = {
-            'latitude': coords['lat'],
-            'longitude': coords['lon'],
-            'current_weather': True,
-            'hourly': 'temperature_2m,relativehumidity_2m',
-            'timezone': 'auto',
-            'forecast_days': 1
-        }
-        
         # запрос к апи
-        response = requests.get(OPENMETEO_URL, params=params, timeout=10)
+        response = await client.get(_CITY_URLS[coords])
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
-        # текущая погоду
-        current = data['current_weather']
-        weather_code = current['weathercode']
+        # текущая погода
+        current = data['current']
+        weather_code = current['weather_code']
         
         # описание погоды
         description = WEATHER_CODES.get(weather_code, "Неизвестно")
         
-        # влажность
-        humidity = None
-        if 'hourly' in data and 'relativehumidity_2m' in data['hourly']:
-            humidities = data['hourly']['relativehumidity_2m']
-            if humidities:
-                humidity = humidities[0]
-        
         return {
-            'temperature': current['temperature'],
-            'humidity': humidity or 50,
+            'temperature': current['temperature_2m'],
+            'humidity': current.get('relative_humidity_2m', 50),
             'description': description,
-            'windspeed': current['windspeed'],
-            'winddirection': current['winddirection'],
+            'windspeed': current['wind_speed_10m'],
+            'winddirection': current['wind_direction_10m'],
             'weathercode': weather_code,
-            'coordinates': coords
+            'coordinates': {'lat': lat, 'lon': lon}
         }
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=503, detail=f"Ошибка при запросе к API погоды: {str(e)}")
     except KeyError as e:
         raise HTTPException(status_code=500, detail=f"Некорректный ответ от API: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка: {str(e)}")
 
+def get_cache_key(lat: float, lon: float) -> str:
+    """ключ кэша по округленным координатам"""
+    return f"wx:{round(lat, 2)}:{round(lon, 2)}"
+
+async def cache_get(cache: aioredis.Redis, key: str):
+    """читаем значение из кэша, недоступный Redis считаем промахом"""
+    try:
+        cached = await cache.get(key)
+    except RedisError:
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+async def fetch_and_cache(coords: Tuple[float, float], key: str, client: httpx.AsyncClient, cache: aioredis.Redis) -> Dict[str, Any]:
+    """получаем погоду из API и сохраняем в кэш"""
+    try:
+        weather_data = await get_weather_from_openmeteo(coords, client)
+    except HTTPException:
+        # API недоступен - отдаем последний сохраненный ответ, даже устаревший
+        stale = await cache_get(cache, f"{key}:stale")
+        if stale is None:
+            raise
+        return stale
+
+    payload = orjson.dumps(weather_data)
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            pipe.set(key, payload, ex=CACHE_TTL)
+            pipe.set(f"{key}:stale", payload, ex=STALE_TTL)
+            await pipe.execute()
+    except RedisError:
+        pass
+
+    return weather_data
+
+async def get_weather_cached(city: str, client: httpx.AsyncClient, cache: aioredis.Redis) -> Dict[str, Any]:
+    """получаем погоду из кэша или из API с сохранением в кэш"""
+    # неизвестный город - сразу 404, без запроса к API и записи в кэш
+    coords = get_city_coordinates(city)
+    if coords is None:
+        raise HTTPException(status_code=404, detail=f"Город не поддерживается: {city}. Список городов: GET /available-cities")
+    key = get_cache_key(*coords)
+
+    cached = await cache_get(cache, key)
+    if cached is not None:
+        CACHE_HITS.inc()
+        return cached
+    CACHE_MISSES.inc()
+
+    # одновременные промахи по одному ключу ждут один и тот же запрос к API
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_and_cache(coords, key, client, cache))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
 
-@app.get("/weather/{city}")
-async def get_weather_by_city(city: str, db: Session = Depends(get_db)):
+    # shield - отмена одного клиента не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+
+@app.get("/weather/{city}", response_model=schemas.WeatherResponse)
+async def get_weather_by_city(city: str, request: Request):
     """GET endpoint для получения погоды"""
-    start_time = time.time()
+    with REQUEST_LATENCY.time():
+        try:
+            weather_data = await get_weather_cached(city, request.app.state.http, request.app.state.redis)
+            
+            timestamp = datetime.utcnow()
+            
+            # сохраняем в бд в фоне, не дожидаясь записи
+            try:
+                request.app.state.write_queue.put_nowait({
+                    'city': city,
+                    'temperature': weather_data['temperature'],
+                    'humidity': weather_data['humidity'],
+                    'description': weather_data['description'],
+                    'windspeed': weather_data.get('windspeed'),
+                    'winddirection': weather_data.get('winddirection'),
+                    'weathercode': weather_data.get('weathercode'),
+                    'timestamp': timestamp
+                })
+            except asyncio.QueueFull:
+                # бд не успевает - не копим записи в памяти, а считаем потерянные
+                WRITES_DROPPED.inc()
+            
+            REQUEST_OK.inc()
+            
+            return {
+                **weather_data,
+                "city": city,
+                "provider": WEATHER_API_PROVIDER,
+                "timestamp": timestamp
+            }
+            
+        except HTTPException as he:
+            REQUEST_ERR.inc()
+            raise he
+        except Exception as e:
+            REQUEST_ERR.inc()
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/history/", response_model=schemas.HistoryPage)
+async def get_history(
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    limit: int = 10,
+    db: AsyncSession = Depends(get_db)
+):
+    """Получить историю запросов погоды (keyset-пагинация по timestamp, id)"""
+    if before_id is not None and before_ts is None:
+        raise HTTPException(status_code=422, detail="before_id передается только вместе с before_ts")
     
-    try:
-        weather_data = get_weather_from_openmeteo(city)
-        
-        # сохраняем в бд
-        db_weather = models.WeatherRequest(
-            city=city,
-            temperature=weather_data['temperature'],
-            humidity=weather_data['humidity'],
-            description=weather_data['description'],
-            windspeed=weather_data.get('windspeed'),
-            winddirection=weather_data.get('winddirection'),
-            weathercode=weather_data.get('weathercode')
-        )
-        db.add(db_weather)
-        db.commit()
-        db.refresh(db_weather)
-        
-        REQUEST_COUNT.labels(status='success').inc()
-        
-        return {
-            "city": city,
-            "temperature": weather_data['temperature'],
-            "humidity": weather_data['humidity'],
-            "description": weather_data['description'],
-            "windspeed": weather_data.get('windspeed'),
-            "winddirection": weather_data.get('winddirection'),
-            "weathercode": weather_data.get('weathercode'),
-            "coordinates": weather_data.get('coordinates', {}),
-            "provider": WEATHER_API_PROVIDER,
-            "timestamp": datetime.utcnow().isoformat(),
-            "id": db_weather.id
-        }
+    query = select(models.WeatherRequest)
+    
+    # продолжаем со следующей записи после курсора
+    if before_ts is not None:
+        # в бд время хранится в UTC без часового пояса
+        if before_ts.tzinfo is not None:
+            before_ts = before_ts.astimezone(timezone.utc).replace(tzinfo=None)
         
-    except HTTPException as he:
-        REQUEST_COUNT.labels(status='error').inc()
-        raise he
-    except Exception as e:
-        REQUEST_COUNT.labels(status='error').inc()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        latency = time.time() - start_time
-        REQUEST_LATENCY.observe(latency)
-
-@app.get("/metrics")
-async def metrics():
-    """Эндпоинт для сбора метрик Prometheus"""
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
-
-@app.get("/history/")
-async def get_history(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
-    """Получить историю запросов погоды"""
-    history = db.query(models.WeatherRequest).order_by(models.WeatherRequest.timestamp.desc()).offset(skip).limit(limit).all()
+        if before_id is None:
+            query = query.where(models.WeatherRequest.timestamp < before_ts)
+        else:
+            query = query.where(or_(
+                models.WeatherRequest.timestamp < before_ts,
+                and_(models.WeatherRequest.timestamp == before_ts, models.WeatherRequest.id < before_id)
+            ))
     
-    return [
-        {
-            "id": item.id,
-            "city": item.city,
-            "temperature": item.temperature,
-            "humidity": item.humidity,
-            "description": item.description,
-            "windspeed": item.windspeed,
-            "winddirection": item.winddirection,
-            "weathercode": item.weathercode,
-            "timestamp": item.timestamp.isoformat()
-        }
-        for item in history
-    ]
+    result = await db.execute(
+        query.order_by(models.WeatherRequest.timestamp.desc(), models.WeatherRequest.id.desc()).limit(limit)
+    )
+    history = result.scalars().all()
+    
+    next_cursor = None
+    if len(history) == limit and history:
+        last = history[-1]
+        next_cursor = {"before_ts": last.timestamp, "before_id": last.id}
+    
+    return {"items": history, "next_cursor": next_cursor}
 
 @app.get("/weather-codes")
 async def get_weather_codes():
     """Получить расшифровку кодов погоды"""
-    return WEATHER_CODES
+    return Response(WEATHER_CODES_BYTES, media_type="application/json")
 
 @app.get("/available-cities")
 async def get_available_cities():
     """Получить список доступных городов"""
-    cities = list(CITY_COORDINATES.keys())
-    return {
-        "available_cities": cities,
-        "count": len(cities)
-    }
+    return Response(AVAILABLE_CITIES_BYTES, media_type="application/json")
+
+async def get_api_status(client: httpx.AsyncClient) -> str:
+    """проверяем доступность API, результат кэшируем на HEALTH_CACHE_TTL секунд"""
+    if time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL:
+        return _health_cache["api_status"]
+
+    # проверку выполняет только одна корутина, остальные ждут ее результат
+    async with _health_lock:
+        if time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL:
+            return _health_cache["api_status"]
+
+        try:
+            response = await client.get("https://api.open-meteo.com/v1/status", timeout=2)
+            api_status = "healthy" if response.status_code == 200 else "unhealthy"
+        except Exception:
+            api_status = "unreachable"
+
+        _health_cache["ts"] = time.monotonic()
+        _health_cache["api_status"] = api_status
+        return api_status
 
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
     """Проверка здоровья приложения"""
-    try:
-        
-        response = requests.get(
-            "https://api.open-meteo.com/v1/status",
-            timeout=5
-        )
-        api_status = "healthy" if response.status_code == 200 else "unhealthy"
-        
-        return {
-            "status": "healthy",
-            "api_status": api_status,
-            "provider": WEATHER_API_PROVIDER,
-            "timestamp": datetime.utcnow().isoformat(),
-            "version": "1.0.0"
-        }
-    except Exception:
-        return {
-            "status": "healthy",
-            "api_status": "unreachable",
-            "provider": WEATHER_API_PROVIDER,
-            "timestamp": datetime.utcnow().isoformat(),
-            "version": "1.0.0"
-        }
+    return {
+        "status": "healthy",
+        "api_status": await get_api_status(request.app.state.http),
+        "provider": WEATHER_API_PROVIDER,
+        "timestamp": iso_now(),
+        "version": "1.0.0"
+    }
 
 @app.get("/")
 async def root():
     """Корневой endpoint с информацией о API"""
-    return {
-        "message": "Weather API с Open-Meteo",
-        "description": "Бесплатный API погоды без регистрации и ключей",
-        "version": "1.0.0",
-        "endpoints": {
-            "get_weather": "GET /weather/{city}",
-            "history": "GET /history/?skip=0&limit=10",
-            "health": "GET /health",
-            "metrics": "GET /metrics",
-            "weather_codes": "GET /weather-codes",
-            "available_cities": "GET /available-cities",
-            "docs": "GET /docs"
-        },
-        "provider": WEATHER_API_PROVIDER
-    }
+    return Response(ROOT_BYTES, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        # несколько воркеров uvicorn запускает только по строке импорта
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+        access_log=False
+    )
\ No newline at end of file
@@ -0,0 +1,12 @@
+# metrics.py
+# метрики вынесены в отдельный модуль: main.py может импортироваться повторно
+# (python main.py -> uvicorn "main:app"), а регистрировать метрики можно только один раз
+from prometheus_client import Counter, Histogram
+
+REQUEST_COUNT = Counter('weather_requests_total', 'Total weather requests', ['status'])
+REQUEST_OK = REQUEST_COUNT.labels(status='success')
+REQUEST_ERR = REQUEST_COUNT.labels(status='error')
+REQUEST_LATENCY = Histogram('weather_request_latency_seconds', 'Request latency in seconds')
+CACHE_HITS = Counter('cache_hits_total', 'Weather cache hits')
+CACHE_MISSES = Counter('cache_misses_total', 'Weather cache misses')
+WRITES_DROPPED = Counter('weather_writes_dropped_total', 'Weather requests not saved because the write queue was full')
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -15,4 +15,7 @@ class WeatherRequest(Base):
     windspeed = Column(Float, nullable=True)        # <-- ЭТО ПОЛЕ
     winddirection = Column(Float, nullable=True)    # <-- ЭТО ПОЛЕ
     weathercode = Column(Integer, nullable=True)    # <-- ЭТО ПОЛЕ
-    timestamp = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+# индекс под keyset-пагинацию истории: ORDER BY timestamp DESC, id DESC
+Index("ix_weather_timestamp_desc", WeatherRequest.timestamp.desc(), WeatherRequest.id.desc())
\ No newline at end of file
@@ -1,7 +1,7 @@
 # schemas.py
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict, List
 
 class WeatherRequestBase(BaseModel):
     city: str
@@ -23,4 +23,14 @@ class WeatherRequest(WeatherRequestBase):
         from_attributes = True
 
 class WeatherResponse(WeatherRequestBase):
-    timestamp: datetime
\ No newline at end of file
+    coordinates: Dict[str, float] = {}
+    provider: str
+    timestamp: datetime
+
+class HistoryCursor(BaseModel):
+    before_ts: datetime
+    before_id: int
+
+class HistoryPage(BaseModel):
+    items: List[WeatherRequest]
+    next_cursor: Optional[HistoryCursor] = None
\ No newline at end of file